@@ -1,13 +1,75 @@
-import json
+import hashlib
 import logging
+import os
+import re
+import textwrap
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import requests
-import boto3
-from langdetect import detect, DetectorFactory
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from langdetect import DetectorFactory
+from langdetect.detector_factory import PROFILES_DIRECTORY
 from botocore.exceptions import ClientError
 
+# orjson is much faster on the hot path; fall back to the stdlib if it isn't installed.
+# _json_dumps always returns compact UTF-8 bytes.
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    import json
+
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+    _json_loads = json.loads
+
 # Ensure consistent results from langdetect
 DetectorFactory.seed = 0
 
+# Only English and French are supported, so only load those langdetect profiles
+LANGDETECT_LANGUAGES = ["en", "fr"]
+
+# langdetect factory, loaded once on first use and reused for every detection
+_LANGDETECT_FACTORY = None
+
+def _get_langdetect_factory():
+    """
+    Return the shared langdetect factory, loading only LANGDETECT_LANGUAGES
+    instead of all 55 bundled profiles.
+    """
+    global _LANGDETECT_FACTORY
+    if _LANGDETECT_FACTORY is None:
+        profiles = []
+        for lang in LANGDETECT_LANGUAGES:
+            with open(os.path.join(PROFILES_DIRECTORY, lang), encoding="utf-8") as f:
+                profiles.append(f.read())
+        factory = DetectorFactory()
+        factory.load_json_profile(profiles)
+        _LANGDETECT_FACTORY = factory
+    return _LANGDETECT_FACTORY
+
+# Only this many leading characters are classified (and used as the memo key)
+_DETECT_PREFIX_CHARS = 256
+
+# Cheap en/fr signals checked before falling back to langdetect
+_FR_DIACRITIC = re.compile(r"[àâçéèêëîïôùûüÿœæÀÂÇÉÈÊËÎÏÔÙÛÜŸŒÆ]")
+_WORD = re.compile(r"[a-zà-öø-ÿœ']+")
+_FR_STOPWORDS = frozenset({
+    "le", "la", "les", "de", "du", "des", "et", "est", "une", "un",
+    "pour", "que", "dans", "avec", "votre", "vos", "quel", "quelle",
+    "vous", "nous", "ça", "être", "sur", "au", "aux", "qui",
+})
+_EN_STOPWORDS = frozenset({
+    "the", "of", "and", "is", "an", "to", "for", "in", "with",
+    "your", "what", "how", "does", "do", "are", "you",
+})
+
+# Echoed "Response:" labels the model sometimes emits before its answer
+_RESPONSE_PREFIXES = ("**Response**:", "Response:")
+
 # Set up logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -15,68 +77,207 @@ logger.setLevel(logging.INFO)
 # Hardcoded API Endpoint
 API_URL = "https://api.happly.ai/api/v1/portal/users/"
 
+# Profile API (connect, read) timeouts. With the retry policy below, at most 3 attempts are
+# made, read timeouts are not retried, and Retry-After is ignored. Backoff with
+# backoff_factor=0.3 is at most 0.6 s per retry, so the worst case is about 3 x 6 s plus
+# under 1 s of backoff, which stays inside the Lambda/API Gateway budget.
+_API_TIMEOUT = (2, 4)
+
+# Pooled HTTP session so keep-alive connections to the API survive warm invocations
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": "happly-lambda"})
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=2,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=False,
+        ),
+    ),
+)
+
+# In-process cache of user profiles: url -> (expiry, data)
+_USER_CACHE = {}
+_USER_CACHE_TTL = 60
+_USER_CACHE_MAXSIZE = 128
+
+# In-process cache of generated answers: blake2b(model_id + body) -> (expiry, answer).
+# Shared by batch worker threads, hence the lock.
+_RESPONSE_CACHE = {}
+_RESPONSE_CACHE_TTL = 300
+_RESPONSE_CACHE_MAXSIZE = 256
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+# Largest document_text accepted in a request (~50k tokens), bounds prompt size
+_MAX_DOCUMENT_CHARS = 200_000
+
+# Generation caps: free-form answers vs. picking one of the provided options
+_MAX_GEN_LEN = 300
+_MAX_GEN_LEN_OPTIONS = 150
+_MAX_GEN_LEN_LIMIT = 2048  # Bedrock's upper bound for Llama max_gen_len
+
+# Generations longer than this are read with the streaming API
+_STREAM_MIN_GEN_LEN = 512
+
+# Bedrock client, created on first use and reused across warm invocations
+_BEDROCK = None
+
+def _get_bedrock():
+    """
+    Return the shared Bedrock runtime client, creating it on first use.
+    """
+    global _BEDROCK
+    if _BEDROCK is None:
+        # Imported here so cold starts that never reach Bedrock don't pay for boto3
+        import boto3
+        from botocore.config import Config
+
+        _BEDROCK = boto3.client(
+            service_name="bedrock-runtime",
+            region_name="us-east-1",
+            config=Config(
+                retries={"max_attempts": 3, "mode": "adaptive"},
+                tcp_keepalive=True,
+                max_pool_connections=32,
+                connect_timeout=2,
+                read_timeout=30,
+            ),
+        )
+    return _BEDROCK
+
 def fetch_user_data(client_id=None):
     """
     Fetch user data from the API endpoint. Use default profile if client_id is not provided.
     """
     url = API_URL + (client_id if client_id else "default-profile-id")
     try:
-        response = requests.get(url)
+        response = _SESSION.get(url, timeout=_API_TIMEOUT)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.HTTPError as http_err:
-        logger.error(f"HTTP error occurred: {http_err}")
+        logger.error("HTTP error occurred: %s", http_err)
     except Exception as e:
-        logger.error(f"Error fetching user data from API ({url}): {e}")
+        logger.error("Error fetching user data from API (%s): %s", url, e)
     return {}
 
+def fetch_user_data_cached(client_id=None):
+    """
+    Fetch user data, reusing a recent result for the same profile if one is cached.
+    Empty (failed) results are not cached.
+    """
+    url = API_URL + (client_id if client_id else "default-profile-id")
+    now = time.monotonic()
+    cached = _USER_CACHE.get(url)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    user_data = fetch_user_data(client_id)
+    if user_data:
+        if len(_USER_CACHE) >= _USER_CACHE_MAXSIZE:
+            _USER_CACHE.pop(next(iter(_USER_CACHE)))
+        _USER_CACHE[url] = (now + _USER_CACHE_TTL, user_data)
+    return user_data
+
 def detect_language(text):
     """
     Detects the language of a given text.
+    Counts of en/fr stopwords and accented words settle most inputs; langdetect is
+    only used when those are inconclusive. Only the first _DETECT_PREFIX_CHARS characters
+    are classified, and results are memoized on them.
     """
+    if not isinstance(text, str):
+        logger.warning("Language detection failed: expected text, got %s", type(text).__name__)
+        return "en"
+    return _detect_language_cached(text[:_DETECT_PREFIX_CHARS])
+
+@lru_cache(maxsize=1024)
+def _detect_language_cached(text):
     try:
-        language = detect(text)
+        words = _WORD.findall(text.lower())
+        fr_hits = sum(word in _FR_STOPWORDS for word in words)
+        en_hits = sum(word in _EN_STOPWORDS for word in words)
+        # Accented words count as French evidence rather than deciding outright, so
+        # names like "Montréal" or "Café Olé" don't outweigh English stopwords
+        if not text.isascii():
+            fr_hits += sum(_FR_DIACRITIC.search(word) is not None for word in words)
+        if fr_hits != en_hits:
+            return "fr" if fr_hits > en_hits else "en"
+
+        # Ambiguous, let langdetect decide
+        detector = _get_langdetect_factory().create()
+        detector.append(text)
+        language = detector.detect()
         if language not in ["en", "fr"]:
             raise ValueError(f"Unsupported language detected: {language}")
         return language
     except Exception as e:
-        logger.warning(f"Language detection failed: {e}")
+        logger.warning("Language detection failed: %s", e)
         return "en"  # Default to English if detection fails
 
 def generate_text(model_id, body):
     """
     Generate text using Meta Llama 3.2 Chat on demand.
     """
-    bedrock = boto3.client(service_name="bedrock-runtime", region_name="us-east-1")
+    bedrock = _get_bedrock()
     response = bedrock.invoke_model(
         body=body,
         modelId=model_id,
         contentType="application/json",
         accept="application/json",
     )
-    response_body = json.loads(response.get("body").read())
+    response_body = _json_loads(response["body"].read())
     return response_body
 
+def generate_text_stream(model_id, body):
+    """
+    Generate text using the Bedrock streaming API, accumulating chunks as they arrive.
+    Returns the same shape as `generate_text`.
+    """
+    bedrock = _get_bedrock()
+    response = bedrock.invoke_model_with_response_stream(
+        body=body,
+        modelId=model_id,
+        contentType="application/json",
+        accept="application/json",
+    )
+    parts = []
+    for event in response["body"]:
+        chunk = event.get("chunk")
+        if chunk:
+            parts.append(_json_loads(chunk["bytes"]).get("generation", ""))
+    return {"generation": "".join(parts)}
+
 def clean_response(response_text):
     """
     Cleans unwanted characters or system tokens from the response.
     """
-    res = response_text.split("\n", 1)
-    if len(res) > 1:
-        res = res[1].strip()
-    else:
-        res = res[0].strip()
-    return res
+    res = response_text
+    newline = res.find("\n")
+    if newline != -1 and res[newline + 1:].strip():
+        res = res[newline + 1:]
+    res = res.lstrip()
+    for prefix in _RESPONSE_PREFIXES:
+        if res.startswith(prefix):
+            res = res[len(prefix):]
+            break
+    return res.strip()
 
-def generate_prompt(language, question, user_data, document_text=None, options=None, rewrite=None):
+def render_user_data(user_data):
     """
-    Generate the input prompt for the AI model in the appropriate language.
-    If `rewrite` is provided, it is used as context for rewriting.
+    Serialize user data compactly for the prompt, dropping fields with empty values.
     """
-    context = f"Rewrite context: {rewrite}" if rewrite else ""
+    if isinstance(user_data, dict):
+        user_data = {k: v for k, v in user_data.items() if v not in (None, "", [], {})}
+    return _json_dumps(user_data).decode()
 
-    if language == "en":
-        return f"""
+# Prompt templates, filled in by generate_prompt. Dedented once at import so the
+# source indentation isn't sent to the model as extra tokens.
+_PROMPT_EN = textwrap.dedent("""
         You are an expert at generating precise, professional, and compelling answers to grant application questions based on the provided **Business Information**, **Options**, and **Document Text**.
 
         **Instructions**:
@@ -90,13 +291,13 @@ def generate_prompt(language, question, user_data, document_text=None, options=N
         **{context}**
 
         **Question**: {question}
-        **Options**: {options or "Not provided"}
-        **Business Information**: {json.dumps(user_data, indent=4)}
-        **Document Text**: {document_text or "Not provided"}
+        **Options**: {options}
+        **Business Information**: {user_data}
+        **Document Text**: {document_text}
         **Response**:
-        """
-    elif language == "fr":
-        return f"""
+        """)
+
+_PROMPT_FR = textwrap.dedent("""
         Vous êtes un expert dans la génération de réponses précises, professionnelles et convaincantes aux questions de demande de subvention basées sur les **Informations sur l'entreprise**, les **Options** et le **Texte du document**.
 
         **Instructions**:
@@ -110,58 +311,192 @@ def generate_prompt(language, question, user_data, document_text=None, options=N
         **{context}**
 
         **Question** : {question}
-        **Options** : {options or "Non fourni"}
-        **Informations sur l'entreprise** : {json.dumps(user_data, indent=4)}
-        **Texte du document** : {document_text or "Non fourni"}
+        **Options** : {options}
+        **Informations sur l'entreprise** : {user_data}
+        **Texte du document** : {document_text}
         **Réponse** :
-        """
+        """)
+
+# language -> (template, placeholder for missing fields)
+_PROMPTS = {
+    "en": (_PROMPT_EN, "Not provided"),
+    "fr": (_PROMPT_FR, "Non fourni"),
+}
+
+def generate_prompt(language, question, user_data, document_text=None, options=None, rewrite=None,
+                    user_data_json=None):
+    """
+    Generate the input prompt for the AI model in the appropriate language.
+    If `rewrite` is provided, it is used as context for rewriting.
+    If `user_data_json` is provided, it is used instead of re-serializing `user_data`.
+    """
+    if language not in _PROMPTS:
+        return None
+    template, not_provided = _PROMPTS[language]
+    return template.format_map({
+        "context": f"Rewrite context: {rewrite}" if rewrite else "",
+        "question": question,
+        "options": options or not_provided,
+        "user_data": user_data_json if user_data_json is not None else render_user_data(user_data),
+        "document_text": document_text or not_provided,
+    })
 
-def integrate_content_with_grant_writing(question, user_data, document_text=None, options=None, rewrite=None):
+def max_gen_len_for(options=None, requested=None):
+    """
+    Pick a generation cap. A positive integer `requested` cap is used as given (up to
+    Bedrock's limit). Otherwise options-mode answers are just the chosen option text, so
+    the cap is sized to the longest option (roughly 2 characters per token, plus slack).
+    """
+    if isinstance(requested, int) and not isinstance(requested, bool) and requested > 0:
+        return min(requested, _MAX_GEN_LEN_LIMIT)
+    if not options:
+        return _MAX_GEN_LEN
+    if isinstance(options, (list, tuple)):
+        return min(_MAX_GEN_LEN_OPTIONS, max(len(str(option)) for option in options) // 2 + 8)
+    return _MAX_GEN_LEN_OPTIONS
+
+def integrate_content_with_grant_writing(question, user_data, document_text=None, options=None, rewrite=None,
+                                         user_data_json=None, max_gen_len=None, regenerate=False):
     """
     Generate a response to a question using user data, document text, and options.
     Handles rewrites by including additional context and optionally includes document text.
+    Pass `user_data_json` (from `render_user_data`) to reuse one serialization across questions,
+    and `max_gen_len` to override the default generation cap.
+    Non-empty answers are cached for identical requests for _RESPONSE_CACHE_TTL seconds;
+    pass `regenerate=True` to skip the cached answer and sample a fresh one.
     """
     language = detect_language(question)
-    prompt = generate_prompt(language, question, user_data, document_text, options, rewrite)
+    prompt = generate_prompt(language, question, user_data, document_text, options, rewrite, user_data_json)
 
-    logger.info(f"Generated Prompt: {prompt}")
+    logger.debug("Generated Prompt: %s", prompt)
 
     model_id = "us.meta.llama3-2-90b-instruct-v1:0"
-    body = json.dumps(
+    max_gen_len = max_gen_len_for(options, max_gen_len)
+    body = _json_dumps(
         {
             "prompt": prompt,
-            "max_gen_len": 300,
+            "max_gen_len": max_gen_len,
             "temperature": 0.7,
         }
     )
 
+    cache_key = hashlib.blake2b(model_id.encode() + body, digest_size=16).digest()
+    cached = None if regenerate else _RESPONSE_CACHE.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
     try:
-        response = generate_text(model_id, body)
+        if max_gen_len > _STREAM_MIN_GEN_LEN:
+            response = generate_text_stream(model_id, body)
+        else:
+            response = generate_text(model_id, body)
         generated_text = response.get("generation", "")
-        return clean_response(generated_text)
+        answer = clean_response(generated_text)
+        if answer:
+            with _RESPONSE_CACHE_LOCK:
+                if len(_RESPONSE_CACHE) >= _RESPONSE_CACHE_MAXSIZE:
+                    _RESPONSE_CACHE.pop(next(iter(_RESPONSE_CACHE)))
+                _RESPONSE_CACHE[cache_key] = (time.monotonic() + _RESPONSE_CACHE_TTL, answer)
+        return answer
     except ClientError as err:
         message = err.response["Error"]["Message"]
-        logger.error(f"A client error occurred: {message}")
+        logger.error("A client error occurred: %s", message)
+        # Invalid requests will never succeed; let the handler answer 400 straight away
+        if err.response["Error"].get("Code") == "ValidationException":
+            raise
         return "Error in generating response"
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
+        logger.error("Unexpected error: %s", e)
         return "Error in generating response"
 
+def integrate_batch_with_grant_writing(questions, user_data, document_text=None, options=None, rewrite=None,
+                                       user_data_json=None, max_gen_len=None, regenerate=False, max_workers=8):
+    """
+    Generate responses for several questions concurrently, in the order given.
+    Each item is either a question string or a dict with `question` and optional
+    `options`, `rewrite`, `document_text`, `max_gen_len` and `regenerate` (defaulting to the
+    shared values). An item Bedrock rejects as invalid gets an error string in its slot.
+    """
+    if not questions:
+        return []
+    if user_data_json is None:
+        user_data_json = render_user_data(user_data)
+
+    def answer(item):
+        if not isinstance(item, dict):
+            item = {"question": item}
+        try:
+            return integrate_content_with_grant_writing(
+                item.get("question"),
+                user_data,
+                item.get("document_text", document_text),
+                item.get("options", options),
+                item.get("rewrite", rewrite),
+                user_data_json,
+                item.get("max_gen_len", max_gen_len),
+                item.get("regenerate", regenerate) is True,
+            )
+        except ClientError as err:
+            # Report an invalid item in its own slot rather than failing the whole batch
+            return f"Invalid model request: {err.response['Error']['Message']}"
+
+    # Create the client before fanning out so threads don't race to initialize it
+    _get_bedrock()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(questions))) as executor:
+        return list(executor.map(answer, questions))
+
 def lambda_handler(event, context):
     """
     AWS Lambda handler function.
+    If the event has a `questions` list, all of them are answered concurrently and the
+    body is a JSON array of responses in the same order.
     """
-    if "body" in event and event["body"]:
-        event = json.loads(event["body"])
+    # API Gateway proxy events wrap the payload in a JSON "body"; direct invokes don't
+    body = event.get("body")
+    if body and isinstance(body, (str, bytes)) and "question" not in event and "questions" not in event:
+        event = _json_loads(body)
 
     client_id = event.get("client_id", None)
     question = event.get("question")
+    questions = event.get("questions", None)
     document_text = event.get("document_text", None)
     options = event.get("options", None)
     rewrite = event.get("rewrite", None)
+    max_gen_len = event.get("max_gen_len", None)
+    # Only a JSON true counts; strings like "false" must not bypass the answer cache
+    regenerate = event.get("regenerate") is True
+
+    # Reject requests without a question before fetching user data or calling Bedrock
+    if questions is not None:
+        if not isinstance(questions, list) or not questions or not all(
+            item.get("question") if isinstance(item, dict) else item for item in questions
+        ):
+            return {
+                "statusCode": 400,
+                "body": "questions must be a non-empty list of questions"
+            }
+    elif not question:
+        return {
+            "statusCode": 400,
+            "body": "Missing question"
+        }
+
+    document_texts = [document_text] + [
+        item.get("document_text") for item in questions or [] if isinstance(item, dict)
+    ]
+    if any(text is not None and not isinstance(text, str) for text in document_texts):
+        return {
+            "statusCode": 400,
+            "body": "document_text must be a string"
+        }
+    if any(text and len(text) > _MAX_DOCUMENT_CHARS for text in document_texts):
+        return {
+            "statusCode": 413,
+            "body": f"Document text exceeds {_MAX_DOCUMENT_CHARS} characters"
+        }
 
     # Fetch user data based on client ID or default profile
-    user_data = fetch_user_data(client_id)
+    user_data = fetch_user_data_cached(client_id)
 
     if not user_data:
         return {
@@ -171,17 +506,43 @@ def lambda_handler(event, context):
 
     try:
         # Generate response
+        user_data_json = render_user_data(user_data)
+        if questions:
+            responses = integrate_batch_with_grant_writing(
+                questions, user_data, document_text, options, rewrite, user_data_json, max_gen_len, regenerate
+            )
+            return {
+                "statusCode": 200,
+                "body": _json_dumps(responses).decode()
+            }
         response = integrate_content_with_grant_writing(
-            question, user_data, document_text, options, rewrite
+            question, user_data, document_text, options, rewrite, user_data_json, max_gen_len, regenerate
         )
         return {
             "statusCode": 200,
             "body": response
         }
+    except ClientError as err:
+        if err.response["Error"].get("Code") == "ValidationException":
+            return {
+                "statusCode": 400,
+                "body": f"Invalid model request: {err.response['Error']['Message']}"
+            }
+        logger.error("Unexpected error in lambda_handler: %s", err)
+        return {
+            "statusCode": 500,
+            "body": "An error occurred"
+        }
     except Exception as e:
-        logger.error(f"Unexpected error in lambda_handler: {e}")
+        logger.error("Unexpected error in lambda_handler: %s", e)
         return {
             "statusCode": 500,
             "body": "An error occurred"
         }
 
+# Under provisioned concurrency or SnapStart the init phase runs ahead of traffic, so do the
+# one-time setup (boto3 import and Bedrock client, langdetect profiles) at import time instead
+# of on the first request. On-demand environments keep the lazy path.
+if os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE") in ("provisioned-concurrency", "snap-start"):
+    _get_bedrock()
+    _get_langdetect_factory()